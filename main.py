@@ -1,34 +1,225 @@
 import logging
-from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta, time as dtime
 import asyncio
+import atexit
+from dataclasses import dataclass, field
+import hashlib
+import heapq
 import os
-import requests
-from queue import Queue
-import pytz
+import queue
+import random
+import signal
+import sqlite3
+import time
+from typing import Optional
+from zoneinfo import ZoneInfo
+import aiohttp
+import orjson
+try:
+    import uvloop
+except ImportError:  # Not available on Windows; the default asyncio loop is used instead
+    uvloop = None
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, NetworkError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
 
 # ==== TIMEZONE CONFIGURATION ====
-IST = pytz.timezone('Asia/Kolkata')  # Indian Standard Time
+IST = ZoneInfo('Asia/Kolkata')  # Indian Standard Time
 
 def now_ist():
     """Get current time in IST"""
     return datetime.now(IST)
 
+def format_ist(timestamp, fmt='%H:%M'):
+    """Format an epoch timestamp as IST wall-clock time"""
+    return datetime.fromtimestamp(timestamp, IST).strftime(fmt)
+
 # ==== ENVIRONMENT VARIABLES ====
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TOMTOM_API_KEY = os.getenv('TOMTOM_API_KEY')
+USER_DB_PATH = os.getenv('USER_DB_PATH', 'traffic_bot.db')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public HTTPS base URL; long polling is used when unset
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Checked against Telegram's secret-token header; required with WEBHOOK_URL
+PORT = int(os.getenv('PORT', 8443))
+TOMTOM_ROUTE_PARAMS = {'key': TOMTOM_API_KEY, 'traffic': 'true', 'departAt': 'now'}  # Static calculateRoute query params
 
 # ==== CONFIGURATION ====
 TRAFFIC_DELAY_THRESHOLD_MINS = 5  # Only alert if delay > 5 minutes
 MINOR_DELAY_THRESHOLD_MINS = 2    # Show minor delay info but no urgent alert
+CHECK_INTERVAL_SECS = 120         # Re-check traffic every 2 minutes inside a commute window
+CLEAR_CHECK_INTERVAL_SECS = 600   # Back off to 10 minutes while the route is clear, doubling per clear result...
+CLEAR_BACKOFF_CUTOFF_SECS = 900   # ...until 15 minutes before departure
+ROUTE_CACHE_TTL_SECS = 90         # Reuse a TomTom result for the same route for 90 seconds
+DB_FLUSH_DELAY_SECS = 2.0         # Coalesce user state writes into one SQLite flush
+DB_FLUSH_MAX_RETRY_SECS = 60.0    # Failed flushes retry with doubling delays up to this
+MATRIX_BATCH_WINDOW_SECS = 0.5    # Route lookups due within this window share one TomTom request
+MATRIX_MAX_CELLS = 100            # Max origins x destinations per Matrix Routing request
+MATRIX_MAX_CELLS_PER_ROUTE = 1.5  # Only batch while billed cells stay within 1.5x the routes actually needed
+TELEGRAM_GLOBAL_RATE = 28         # Bot API requests/sec across all chats (Telegram allows ~30)
+TELEGRAM_RATE_LIMIT_RETRIES = 3   # Flood-control retries the rate limiter makes before giving up
+CONCURRENT_UPDATES = 256          # Updates handled at once; handlers mostly wait on I/O
+SEND_MAX_ATTEMPTS = 8             # Give up on a message after this many tries
+SEND_BACKOFF_BASE_SECS = 0.5      # Network error backoff: full jitter up to base * 2^attempt...
+SEND_BACKOFF_MAX_SECS = 30        # ...capped here
+BATCH_FLUSH_INTERVAL = 3.0        # Updates for the same chat within this window go out as one message
+MAX_BATCH_CHARS = 4000            # Split batches to stay under Telegram's 4096-char message limit
+BATCH_SEPARATOR = "\n\n---\n\n"
+REPEAT_MESSAGE_WINDOW_SECS = 1200 # Identical failure notices are re-sent at most every 20 minutes
+STALE_SETUP_DAYS = 30             # Forget users who abandon setup for this long
+USER_GC_INTERVAL_SECS = 3600      # How often to look for abandoned setups
+
+# Traffic update message per delay tier (0 = clear, 1 = minor, 2 = urgent)
+ALERT_TEMPLATES = tuple("\n".join(lines) for lines in (
+    (
+        "✅ {route} Traffic Update",
+        "⏰ Time: {time}",
+        "🕐 Travel time: {travel} mins",
+        "🚦 No delays - all clear!",
+    ),
+    (
+        "⚠️ {route} Traffic Update",
+        "⏰ Time: {time}",
+        "🕐 Total travel time: {travel} mins",
+        "🚦 Minor delay: {delay} mins",
+        "ℹ️ Normal traffic conditions",
+    ),
+    (
+        "🚨 {route} Traffic Alert!",
+        "⏰ Time: {time}",
+        "🕐 Total travel time: {travel} mins",
+        "🚦 Traffic delay: {delay} mins",
+        "💡 Consider leaving early!",
+    ),
+))
+
+# ==== PERSISTENCE ====
+
+class PersistentDict(dict):
+    """Dict keyed by chat_id that marks the chat dirty whenever a user is added or removed.
+
+    Handlers that update a UserRecord in place call mark_dirty themselves; the row is
+    serialized at flush time, so several updates in one handler cost a single write.
+    """
+
+    def __setitem__(self, chat_id, value):
+        super().__setitem__(chat_id, value)
+        mark_dirty(chat_id)
+
+    def __delitem__(self, chat_id):
+        super().__delitem__(chat_id)
+        mark_dirty(chat_id)
+
+    def pop(self, chat_id, *default):
+        value = super().pop(chat_id, *default)
+        mark_dirty(chat_id)
+        return value
+
+TIME_FIELDS = ("office_start_time", "home_start_time")
+PERSISTED_FIELDS = TIME_FIELDS + ("home_lat", "home_lon", "office_lat", "office_lon", "office_url", "home_url", "last_seen")
+
+def encode_user_data(user):
+    """Serialize a user's saved fields to JSON (times as HH:MM); scheduler fields are recomputed on startup."""
+    data = {}
+    for key in PERSISTED_FIELDS:
+        value = getattr(user, key)
+        if value is not None:
+            data[key] = value.strftime("%H:%M") if key in TIME_FIELDS else value
+    return orjson.dumps(data).decode()
+
+def decode_user_data(state, data_json):
+    """Inverse of encode_user_data."""
+    data = orjson.loads(data_json)
+    for key in TIME_FIELDS:
+        if key in data:
+            data[key] = dtime.fromisoformat(data[key])
+    return UserRecord(state=state, **{key: data[key] for key in PERSISTED_FIELDS if key in data})
+
+def open_user_db(path):
+    """Open the SQLite user store and load every saved user into memory."""
+    global user_db
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS users (chat_id INTEGER PRIMARY KEY, state TEXT, data_json TEXT)")
+    
+    # user_db is still None here, so loading doesn't mark anything dirty
+    for chat_id, state, data_json in conn.execute("SELECT chat_id, state, data_json FROM users"):
+        users[chat_id] = decode_user_data(state, data_json)
+    
+    user_db = conn
+    logging.info(f"💾 Loaded {len(users)} users from {path}")
+
+def mark_dirty(chat_id):
+    """Queue a user's row for saving; writes are coalesced into one debounced flush."""
+    global flush_handle
+    if user_db is None:
+        return
+    dirty_users.add(chat_id)
+    if flush_handle is None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # No loop yet; picked up by the next flush
+        flush_handle = loop.call_later(DB_FLUSH_DELAY_SECS, flush_user_db)
+
+def flush_user_db():
+    """Write every dirty user to SQLite in a single transaction, re-arming a retry if it fails."""
+    global flush_handle, flush_retry_delay
+    if flush_handle:
+        flush_handle.cancel()
+    flush_handle = None
+    if user_db is None or not dirty_users:
+        return
+    
+    rows, removed = [], []
+    for chat_id in dirty_users:
+        user = users.get(chat_id)
+        if user:
+            rows.append((chat_id, user.state, encode_user_data(user)))
+        else:
+            removed.append((chat_id,))
+    dirty_users.clear()
+    
+    try:
+        with user_db:
+            user_db.executemany(
+                "INSERT INTO users (chat_id, state, data_json) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, data_json = excluded.data_json",
+                rows
+            )
+            user_db.executemany("DELETE FROM users WHERE chat_id = ?", removed)
+        logging.info(f"💾 Saved {len(rows)} users, removed {len(removed)}")
+        flush_retry_delay = DB_FLUSH_DELAY_SECS
+    except Exception as e:
+        logging.error(f"💥 Error saving user state: {e}, retrying in {flush_retry_delay:.0f}s")
+        # The transaction rolled back; keep the rows dirty and retry them on a backoff
+        dirty_users.update(chat_id for chat_id, *_ in rows + removed)
+        try:
+            flush_handle = asyncio.get_running_loop().call_later(flush_retry_delay, flush_user_db)
+        except RuntimeError:
+            return  # No loop (e.g. final shutdown flush); nothing left to retry on
+        flush_retry_delay = min(flush_retry_delay * 2, DB_FLUSH_MAX_RETRY_SECS)
 
 # ==== GLOBALS ====
-user_data = {}  # Stores user info: location, times, etc.
-user_state = {}  # Tracks user's current state in setup process
-message_queue = Queue()  # Queue for thread-safe message sending
-user_next_checks = {}  # For async scheduler: {chat_id: {"office": datetime, "home": datetime, "office_end": datetime, "home_end": datetime}}
+users = PersistentDict()  # One UserRecord per chat: setup state, commute details, next checks
+user_db = None  # SQLite connection backing users (opened in main)
+dirty_users = set()  # chat_ids with unsaved changes
+flush_handle = None  # Pending debounced flush_user_db timer
+flush_retry_delay = DB_FLUSH_DELAY_SECS  # Delay before retrying a failed flush (doubles per failure)
+check_heap = []  # Pending checks ordered by deadline: [(deadline, chat_id, mode)], may hold stale entries
+armed_checks = {}  # Live deadline per pending check: {(chat_id, mode): deadline}
+wakeup_handle = None  # Single loop timer for the earliest deadline in check_heap
+wakeup_at = None  # Deadline wakeup_handle is armed for
+background_tasks = set()  # In-flight tasks started from timer callbacks (strong refs so they aren't garbage collected)
 app = None  # Global app instance
+http_session = None  # Shared aiohttp session for TomTom API calls (created in post_init)
+route_cache = {}  # TomTom route summaries in expiry order: {(start_lat, start_lon, end_lat, end_lon): (expires_at, summary)}
+pending_routes = {}  # Route lookups waiting for the next batch: {cache_key: (start, end, url, future)}
+inflight_routes = {}  # Route lookups sent to TomTom but not yet settled: {cache_key: future}
+route_batch_handle = None  # Pending start_route_batch timer
+outbox = {}  # Updates waiting to be coalesced: {chat_id: [message, ...]}
+outbox_handle = None  # Pending flush_outbox timer
 
 # User states
 STATE_WAITING_OFFICE_TIME = "waiting_office_time"
@@ -37,22 +228,99 @@ STATE_WAITING_HOME_LOCATION = "waiting_home_location"
 STATE_WAITING_OFFICE_LOCATION = "waiting_office_location"
 STATE_SETUP_COMPLETE = "setup_complete"
 
+@dataclass(slots=True)
+class UserRecord:
+    """Everything tracked for one chat; mode-specific fields are named <mode>_<field>."""
+    state: str = STATE_WAITING_OFFICE_TIME
+    office_start_time: Optional[dtime] = None
+    home_start_time: Optional[dtime] = None
+    home_lat: Optional[float] = None
+    home_lon: Optional[float] = None
+    office_lat: Optional[float] = None
+    office_lon: Optional[float] = None
+    office_url: Optional[str] = None
+    home_url: Optional[str] = None
+    last_seen: float = field(default_factory=time.time)  # Epoch time of the user's last update
+    # Scheduler deadlines as epoch timestamps; None while the mode isn't scheduled
+    office_next: Optional[float] = None
+    office_end: Optional[float] = None
+    home_next: Optional[float] = None
+    home_end: Optional[float] = None
+    # Alert tier last sent in the current window (0 = clear, 1 = minor, 2 = urgent)
+    office_tier: Optional[int] = None
+    home_tier: Optional[int] = None
+    # Consecutive clear results in the current window, driving the polling backoff
+    office_clear_streak: int = 0
+    home_clear_streak: int = 0
+    # (blake2s digest, monotonic time) of the last failure notice sent for each mode
+    office_last_notice: Optional[tuple] = None
+    home_last_notice: Optional[tuple] = None
+
+    @property
+    def is_scheduled(self):
+        return self.office_next is not None or self.home_next is not None
+
 # ==== LOGGING ====
+# Records are formatted by the QueueHandler and written by the listener thread,
+# so file/console I/O never blocks the event loop
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(
+    log_queue,
+    logging.FileHandler('traffic_bot.log'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
     level=logging.INFO,
-    handlers=[
-        logging.FileHandler('traffic_bot.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # ==== BOT COMMANDS AND HANDLERS ====
 
+async def track_last_seen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs ahead of every other handler to stamp the user's last interaction."""
+    user = users.get(update.effective_chat.id) if update.effective_chat else None
+    if user:
+        user.last_seen = time.time()
+        mark_dirty(update.effective_chat.id)  # Persisted so a restart doesn't reset it; flushes are debounced
+
+def require_setup(chat_id):
+    """Return the user's record if their setup is complete, else None."""
+    user = users.get(chat_id)
+    return user if user and user.state == STATE_SETUP_COMPLETE else None
+
+SETUP_INCOMPLETE_MESSAGE = "❌ Setup not complete. Please use /start to configure your commute."
+
+# Thresholds are fixed at import, so the /settings reply never changes
+SETTINGS_MESSAGE = (
+    f"⚙️ Traffic Alert Settings\n\n"
+    f"🚨 Urgent Alert Threshold: {TRAFFIC_DELAY_THRESHOLD_MINS} minutes\n"
+    f"⚠️ Minor Alert Threshold: {MINOR_DELAY_THRESHOLD_MINS} minutes\n\n"
+    f"📊 Current thresholds:\n"
+    f"• ≥{TRAFFIC_DELAY_THRESHOLD_MINS} mins: 🚨 Urgent alert with 'leave early' advice\n"
+    f"• {MINOR_DELAY_THRESHOLD_MINS}-{TRAFFIC_DELAY_THRESHOLD_MINS-1} mins: ⚠️ Minor delay notification\n"
+    f"• <{MINOR_DELAY_THRESHOLD_MINS} mins: ✅ All clear message\n\n"
+    f"💡 Contact admin to adjust thresholds if needed."
+)
+
+# Location request keyboards are immutable, so build them once and reuse them
+HOME_LOCATION_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📍 Share Home Location", request_location=True)]],
+    one_time_keyboard=True,
+    resize_keyboard=True
+)
+OFFICE_LOCATION_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📍 Share Office Location", request_location=True)]],
+    one_time_keyboard=True,
+    resize_keyboard=True
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    user_state[chat_id] = STATE_WAITING_OFFICE_TIME
-    user_data[chat_id] = {}
+    cancel_checks(chat_id)  # Re-running setup drops any checks armed for the old schedule
+    users[chat_id] = UserRecord()
     
     await update.message.reply_text(
         "Welcome to Traffic Alert Bot! 🚗\n\n"
@@ -62,23 +330,31 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    current_state = user_state.get(chat_id)
+    user = users.get(chat_id)
+    handler = TEXT_HANDLERS.get(user.state if user else None)
     
-    if current_state == STATE_WAITING_OFFICE_TIME:
-        await handle_office_time(update, context)
-    elif current_state == STATE_WAITING_HOME_TIME:
-        await handle_home_time(update, context)
+    if handler:
+        await handler(update, context)
     else:
         await update.message.reply_text("Please use /start to begin setup.")
 
+def parse_hhmm(time_str):
+    """Parse a 24-hour HH:MM (or H:MM) string into a time; raises ValueError if invalid."""
+    hours, sep, minutes = time_str.strip().partition(":")
+    if not (sep and hours.isascii() and hours.isdigit() and len(hours) <= 2
+            and minutes.isascii() and minutes.isdigit() and len(minutes) == 2):
+        raise ValueError(f"invalid HH:MM time: {time_str!r}")
+    return dtime(int(hours), int(minutes))  # dtime rejects out-of-range values with ValueError
+
 async def handle_office_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     time_str = update.message.text
     
     try:
-        office_time = datetime.strptime(time_str, "%H:%M").time()
-        user_data[chat_id]["office_start_time"] = office_time
-        user_state[chat_id] = STATE_WAITING_HOME_TIME
+        user = users[chat_id]
+        user.office_start_time = parse_hhmm(time_str)
+        user.state = STATE_WAITING_HOME_TIME
+        mark_dirty(chat_id)
         
         await update.message.reply_text(
             f"✅ Office start time saved: {time_str}\n\n"
@@ -95,19 +371,16 @@ async def handle_home_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time_str = update.message.text
     
     try:
-        home_time = datetime.strptime(time_str, "%H:%M").time()
-        user_data[chat_id]["home_start_time"] = home_time
-        user_state[chat_id] = STATE_WAITING_HOME_LOCATION
+        user = users[chat_id]
+        user.home_start_time = parse_hhmm(time_str)
+        user.state = STATE_WAITING_HOME_LOCATION
+        mark_dirty(chat_id)
         
         await update.message.reply_text(
             f"✅ Home start time saved: {time_str}\n\n"
             "Now, please send me your Home location 🏠\n"
             "Tap the 📍 button below to share your location.",
-            reply_markup=ReplyKeyboardMarkup(
-                [[KeyboardButton("📍 Share Home Location", request_location=True)]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
+            reply_markup=HOME_LOCATION_KEYBOARD
         )
     except ValueError:
         await update.message.reply_text(
@@ -115,74 +388,94 @@ async def handle_home_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Example: 09:30 or 17:45"
         )
 
+# Text replies expected in each setup state
+TEXT_HANDLERS = {
+    STATE_WAITING_OFFICE_TIME: handle_office_time,
+    STATE_WAITING_HOME_TIME: handle_home_time,
+}
+
 async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    current_state = user_state.get(chat_id)
+    user = users.get(chat_id)
+    handler = LOCATION_HANDLERS.get(user.state if user else None)
     
+    if handler:
+        await handler(update, context)
+    else:
+        await update.message.reply_text("Please use /start to begin setup.")
+
+async def handle_home_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
     lat = update.message.location.latitude
     lon = update.message.location.longitude
     
-    if current_state == STATE_WAITING_HOME_LOCATION:
-        user_data[chat_id]["home_lat"] = lat
-        user_data[chat_id]["home_lon"] = lon
-        user_state[chat_id] = STATE_WAITING_OFFICE_LOCATION
-        
-        await update.message.reply_text(
-            f"✅ Home location saved!\n"
-            f"📍 Coordinates: {lat:.4f}, {lon:.4f}\n\n"
-            "Now, please send me your Office location 🏢\n"
-            "Tap the 📍 button below to share your office location.",
-            reply_markup=ReplyKeyboardMarkup(
-                [[KeyboardButton("📍 Share Office Location", request_location=True)]],
-                one_time_keyboard=True,
-                resize_keyboard=True
-            )
-        )
-        
-    elif current_state == STATE_WAITING_OFFICE_LOCATION:
-        user_data[chat_id]["office_lat"] = lat
-        user_data[chat_id]["office_lon"] = lon
-        user_state[chat_id] = STATE_SETUP_COMPLETE
-        
-        await update.message.reply_text(
-            f"✅ Office location saved!\n"
-            f"📍 Coordinates: {lat:.4f}, {lon:.4f}\n\n"
-            "🎉 Setup complete! Your traffic monitoring is now active.\n\n"
-            "📋 Your Schedule:\n"
-            f"🏠➡️🏢 Office departure: {user_data[chat_id]['office_start_time'].strftime('%H:%M')}\n"
-            f"🏢➡️🏠 Home departure: {user_data[chat_id]['home_start_time'].strftime('%H:%M')}\n\n"
-            "You'll receive traffic updates automatically before your commute times!"
-        )
-        
-        # Start async tracking scheduler for this user
-        await schedule_tracking(chat_id)
-        logging.info(f"✅ Async tracking initialized for user {chat_id}")
-        
-        # FORCE VERIFICATION: Check if user was actually added
-        if chat_id in user_next_checks:
-            logging.info(f"🎯 CONFIRMED: User {chat_id} successfully added to scheduler")
-        else:
-            logging.error(f"💥 FAILED: User {chat_id} NOT added to scheduler - calling again")
-            await schedule_tracking(chat_id)  # Try again
-        
+    user = users[chat_id]
+    user.home_lat, user.home_lon = lat, lon
+    user.state = STATE_WAITING_OFFICE_LOCATION
+    mark_dirty(chat_id)
+    
+    await update.message.reply_text(
+        f"✅ Home location saved!\n"
+        f"📍 Coordinates: {lat:.4f}, {lon:.4f}\n\n"
+        "Now, please send me your Office location 🏢\n"
+        "Tap the 📍 button below to share your office location.",
+        reply_markup=OFFICE_LOCATION_KEYBOARD
+    )
+
+async def handle_office_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    lat = update.message.location.latitude
+    lon = update.message.location.longitude
+    
+    user = users[chat_id]
+    user.office_lat, user.office_lon = lat, lon
+    build_route_urls(user)
+    user.state = STATE_SETUP_COMPLETE
+    mark_dirty(chat_id)
+    flush_user_db()  # Write through now so a finished setup survives an immediate restart
+    
+    await update.message.reply_text(
+        f"✅ Office location saved!\n"
+        f"📍 Coordinates: {lat:.4f}, {lon:.4f}\n\n"
+        "🎉 Setup complete! Your traffic monitoring is now active.\n\n"
+        "📋 Your Schedule:\n"
+        f"🏠➡️🏢 Office departure: {user.office_start_time.strftime('%H:%M')}\n"
+        f"🏢➡️🏠 Home departure: {user.home_start_time.strftime('%H:%M')}\n\n"
+        "You'll receive traffic updates automatically before your commute times!"
+    )
+    
+    # Start async tracking scheduler for this user
+    await schedule_tracking(chat_id)
+    logging.info(f"✅ Async tracking initialized for user {chat_id}")
+    
+    # FORCE VERIFICATION: Check if user was actually added
+    if user.is_scheduled:
+        logging.info(f"🎯 CONFIRMED: User {chat_id} successfully added to scheduler")
     else:
-        await update.message.reply_text("Please use /start to begin setup.")
+        logging.error(f"💥 FAILED: User {chat_id} NOT added to scheduler - calling again")
+        await schedule_tracking(chat_id)  # Try again
+
+# Shared locations expected in each setup state
+LOCATION_HANDLERS = {
+    STATE_WAITING_HOME_LOCATION: handle_home_location,
+    STATE_WAITING_OFFICE_LOCATION: handle_office_location,
+}
 
 # ==== ASYNC SCHEDULER LOGIC (FIXED) ====
 
 async def schedule_tracking(chat_id):
     """Initialize next check times for the user."""
-    data = user_data.get(chat_id)
-    if not data:
+    user = users.get(chat_id)
+    if not user:
         logging.error(f"❌ No user data found for chat_id {chat_id}")
         return
 
-    now = now_ist().replace(tzinfo=None)  # Remove timezone info for comparison
+    now = now_ist()
     today = now.date()
     logging.info(f"🕐 Current IST time: {now.strftime('%Y-%m-%d %H:%M:%S')}")
 
     def next_check_time(base_time, before_mins, after_mins):
-        base_datetime = datetime.combine(today, base_time)
+        base_datetime = datetime.combine(today, base_time, tzinfo=IST)
         start_check = base_datetime - timedelta(minutes=before_mins)
         end_check = base_datetime + timedelta(minutes=after_mins)
         
@@ -194,28 +487,27 @@ async def schedule_tracking(chat_id):
         
         return start_check, end_check
 
-    office_start, office_end = next_check_time(data["office_start_time"], 30, 30)
-    home_start, home_end = next_check_time(data["home_start_time"], 60, 30)
+    office_start, office_end = next_check_time(user.office_start_time, 30, 30)
+    home_start, home_end = next_check_time(user.home_start_time, 60, 30)
 
-    user_next_checks[chat_id] = {
-        "office": office_start,
-        "home": home_start,
-        "office_end": office_end,
-        "home_end": home_end
-    }
+    user.office_next, user.office_end = office_start.timestamp(), office_end.timestamp()
+    user.home_next, user.home_end = home_start.timestamp(), home_end.timestamp()
+    user.office_tier = user.home_tier = None
+    user.office_clear_streak = user.home_clear_streak = 0
+    arm_check(chat_id, "office")
+    arm_check(chat_id, "home")
     
     logging.info(f"📋 User {chat_id} schedule:")
     logging.info(f"  🏠➡️🏢 Office window: {office_start.strftime('%H:%M')} to {office_end.strftime('%H:%M')}")
     logging.info(f"  🏢➡️🏠 Home window: {home_start.strftime('%H:%M')} to {home_end.strftime('%H:%M')}")
     
     # CRITICAL: Verify the user was actually added
-    logging.info(f"🔍 Verification - user_next_checks now has {len(user_next_checks)} users")
-    logging.info(f"🔍 User {chat_id} in scheduler: {chat_id in user_next_checks}")
+    logging.info(f"🔍 User {chat_id} in scheduler: {user.is_scheduled}")
 
 async def schedule_tracking_for_mode(chat_id, mode):
     """Schedule the next day's tracking window for a specific mode."""
-    data = user_data.get(chat_id)
-    if not data:
+    user = users.get(chat_id)
+    if not user:
         logging.error(f"❌ No user data for rescheduling {mode} mode for chat_id {chat_id}")
         return
 
@@ -223,213 +515,494 @@ async def schedule_tracking_for_mode(chat_id, mode):
     logging.info(f"📅 Rescheduling {mode} mode for user {chat_id} to tomorrow")
 
     if mode == "office":
-        office_time = data["office_start_time"]
-        start_check = datetime.combine(tomorrow, office_time) - timedelta(minutes=30)
-        end_check = datetime.combine(tomorrow, office_time) + timedelta(minutes=30)
-        user_next_checks[chat_id]["office"] = start_check
-        user_next_checks[chat_id]["office_end"] = end_check
+        base_datetime = datetime.combine(tomorrow, user.office_start_time, tzinfo=IST)
+        start_check = base_datetime - timedelta(minutes=30)
+        end_check = base_datetime + timedelta(minutes=30)
+        user.office_next, user.office_end = start_check.timestamp(), end_check.timestamp()
+        user.office_tier = None
+        user.office_clear_streak = 0
+        arm_check(chat_id, "office")
         logging.info(f"  🏠➡️🏢 Next office window: {start_check.strftime('%H:%M')} to {end_check.strftime('%H:%M')}")
 
     elif mode == "home":
-        home_time = data["home_start_time"]
-        start_check = datetime.combine(tomorrow, home_time) - timedelta(minutes=60)
-        end_check = datetime.combine(tomorrow, home_time) + timedelta(minutes=30)
-        user_next_checks[chat_id]["home"] = start_check
-        user_next_checks[chat_id]["home_end"] = end_check
+        base_datetime = datetime.combine(tomorrow, user.home_start_time, tzinfo=IST)
+        start_check = base_datetime - timedelta(minutes=60)
+        end_check = base_datetime + timedelta(minutes=30)
+        user.home_next, user.home_end = start_check.timestamp(), end_check.timestamp()
+        user.home_tier = None
+        user.home_clear_streak = 0
+        arm_check(chat_id, "home")
         logging.info(f"  🏢➡️🏠 Next home window: {start_check.strftime('%H:%M')} to {end_check.strftime('%H:%M')}")
 
-async def async_scheduler():
-    """Main async scheduler loop checking all users and sending updates."""
-    logging.info("🚀 Async scheduler started!")
+def arm_check(chat_id, mode):
+    """Queue the user's next `mode` check at its deadline, superseding any pending one."""
+    deadline = getattr(users[chat_id], f"{mode}_next")
+    armed_checks[(chat_id, mode)] = deadline
+    heapq.heappush(check_heap, (deadline, chat_id, mode))
+    # Superseded entries normally wait until they reach the top; once they outnumber
+    # the live ones (e.g. after many /start re-runs), rebuild the heap without them
+    if len(check_heap) > 2 * len(armed_checks) + 64:
+        check_heap[:] = [entry for entry in check_heap if armed_checks.get(entry[1:]) == entry[0]]
+        heapq.heapify(check_heap)
+    schedule_wakeup()
+
+def schedule_wakeup():
+    """Point the single scheduler timer at the earliest live deadline in check_heap."""
+    global wakeup_handle, wakeup_at
+    # Discard cancelled/superseded entries so they don't cause early wakeups
+    while check_heap and armed_checks.get(check_heap[0][1:]) != check_heap[0][0]:
+        heapq.heappop(check_heap)
+    if not check_heap:
+        if wakeup_handle is not None:
+            wakeup_handle.cancel()  # Nothing left to run; stay asleep until the next arm_check
+        wakeup_handle = wakeup_at = None
+        return
     
-    while True:
-        try:
-            now = now_ist().replace(tzinfo=None)  # Remove timezone info for comparison
-            
-            # Debug log every 5 minutes instead of 10
-            if now.minute % 5 == 0 and now.second < 30:
-                logging.info(f"💓 Scheduler heartbeat - Active users: {len(user_next_checks)}")
-                for chat_id, checks in user_next_checks.items():
-                    logging.info(f"  User {chat_id}: Office {checks.get('office', 'N/A')}, Home {checks.get('home', 'N/A')}")
-            
-            for chat_id, checks in list(user_next_checks.items()):
-                data = user_data.get(chat_id)
-                if not data:
-                    logging.warning(f"⚠️ No user data for chat_id {chat_id}, removing from scheduler")
-                    del user_next_checks[chat_id]
-                    continue
-
-                # OFFICE check window
-                if checks.get("office") and checks.get("office_end"):
-                    if checks["office"] <= now <= checks["office_end"]:
-                        if now >= checks["office"]:
-                            logging.info(f"🏠➡️🏢 Sending office traffic update for user {chat_id}")
-                            await send_tomtom_update_async(chat_id, "office")
-                            # Schedule next check in 2 minutes (changed from 15 to 2)
-                            user_next_checks[chat_id]["office"] = now + timedelta(minutes=2)
-                    elif now > checks["office_end"]:
-                        logging.info(f"📅 Office window ended for user {chat_id}, scheduling for tomorrow")
-                        await schedule_tracking_for_mode(chat_id, "office")
-
-                # HOME check window
-                if checks.get("home") and checks.get("home_end"):
-                    if checks["home"] <= now <= checks["home_end"]:
-                        if now >= checks["home"]:
-                            logging.info(f"🏢➡️🏠 Sending home traffic update for user {chat_id}")
-                            await send_tomtom_update_async(chat_id, "home")
-                            # Schedule next check in 2 minutes (changed from 15 to 2)
-                            user_next_checks[chat_id]["home"] = now + timedelta(minutes=2)
-                    elif now > checks["home_end"]:
-                        logging.info(f"📅 Home window ended for user {chat_id}, scheduling for tomorrow")
-                        await schedule_tracking_for_mode(chat_id, "home")
+    deadline = check_heap[0][0]
+    if wakeup_handle is not None:
+        if wakeup_at == deadline:
+            return  # Already armed for it
+        wakeup_handle.cancel()  # Earliest check moved (earlier, or later after a cancel)
+    wakeup_at = deadline
+    wakeup_handle = asyncio.get_running_loop().call_later(max(0.0, deadline - time.time()), run_due_checks)
 
-        except Exception as e:
-            logging.error(f"💥 Error in async scheduler: {e}")
+def run_due_checks():
+    """Timer callback: start every check whose deadline has passed, then re-arm the timer."""
+    global wakeup_handle
+    wakeup_handle = None
+    now = time.time()
+    
+    while check_heap and check_heap[0][0] <= now:
+        deadline, chat_id, mode = heapq.heappop(check_heap)
+        if armed_checks.get((chat_id, mode)) != deadline:
+            continue  # Cancelled or rescheduled since it was pushed
+        del armed_checks[(chat_id, mode)]
+        spawn(fire_check(chat_id, mode))
+    
+    schedule_wakeup()
+
+def spawn(coro):
+    """Start a background task, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def fire_check(chat_id, mode):
+    """Send one traffic update, then arm the next check in this window or tomorrow's window."""
+    try:
+        user = users.get(chat_id)
+        if not user or getattr(user, f"{mode}_next") is None:
+            return
+        
+        if user.state != STATE_SETUP_COMPLETE:
+            logging.warning(f"⚠️ No user data for chat_id {chat_id}, removing from scheduler")
+            cancel_checks(chat_id)
+            return
         
-        await asyncio.sleep(30)  # Check every 30 seconds (reduced from 60)
+        now = time.time()
+        route_icon = "🏠➡️🏢" if mode == "office" else "🏢➡️🏠"
+        logging.info(f"{route_icon} Sending {mode} traffic update for user {chat_id}")
+        tier = await send_tomtom_update(chat_id, mode, only_changes=True)
+        
+        # /start may have replaced or cancelled this user while the update was in flight
+        if users.get(chat_id) is not user or getattr(user, f"{mode}_end") is None:
+            return
+        
+        # Next check in 2 minutes while still inside the window; while the route stays clear
+        # and departure is still a while off, back off exponentially (10, 20, 40... minutes)
+        streak = getattr(user, f"{mode}_clear_streak") + 1 if tier == 0 else 0
+        setattr(user, f"{mode}_clear_streak", streak)
+        window_end = getattr(user, f"{mode}_end")
+        departure = window_end - 30 * 60  # Both windows close 30 minutes after departure
+        next_check = now + CHECK_INTERVAL_SECS
+        if streak and departure - now > CLEAR_BACKOFF_CUTOFF_SECS:
+            backoff = CLEAR_CHECK_INTERVAL_SECS * 2 ** (streak - 1)
+            next_check = max(next_check, min(now + backoff, departure - CLEAR_BACKOFF_CUTOFF_SECS))
+        if next_check <= window_end:
+            setattr(user, f"{mode}_next", next_check)
+            arm_check(chat_id, mode)
+        else:
+            logging.info(f"📅 {mode.capitalize()} window ended for user {chat_id}, scheduling for tomorrow")
+            await schedule_tracking_for_mode(chat_id, mode)
+    
+    except Exception as e:
+        logging.error(f"💥 Error in scheduled {mode} check for user {chat_id}: {e}")
 
-async def send_tomtom_update_async(chat_id, mode):
-    """Async wrapper for sending TomTom update (calls sync code inside)."""
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, send_tomtom_update, chat_id, mode)
+def cancel_checks(chat_id):
+    """Remove the user from the scheduler; their heap entries are skipped when popped."""
+    user = users.get(chat_id)
+    if user:
+        user.office_next = user.office_end = user.home_next = user.home_end = None
+    for mode in ("office", "home"):
+        armed_checks.pop((chat_id, mode), None)
+    schedule_wakeup()
+
+async def scheduler_heartbeat():
+    """Periodically log scheduler state; checks themselves are driven by run_due_checks."""
+    logging.info("🚀 Async scheduler started!")
+    
+    while True:
+        await asyncio.sleep(300)  # Heartbeat every 5 minutes
+        # The armed wakeup is the earliest pending check, so this stays O(1) however many users there are
+        next_due = format_ist(wakeup_at, '%Y-%m-%d %H:%M:%S') if wakeup_at else 'N/A'
+        logging.info(f"💓 Scheduler heartbeat - Pending checks: {len(armed_checks)}, next due: {next_due}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for chat_id, user in users.items():
+                if user.is_scheduled:
+                    office_next, home_next = user.office_next, user.home_next
+                    logging.debug(
+                        f"  User {chat_id}: Office {format_ist(office_next, '%Y-%m-%d %H:%M') if office_next else 'N/A'}, "
+                        f"Home {format_ist(home_next, '%Y-%m-%d %H:%M') if home_next else 'N/A'}"
+                    )
+
+async def prune_stale_users():
+    """Hourly, forget users who started setup but haven't been heard from in STALE_SETUP_DAYS."""
+    while True:
+        await asyncio.sleep(USER_GC_INTERVAL_SECS)
+        cutoff = time.time() - STALE_SETUP_DAYS * 86400
+        stale = [
+            chat_id for chat_id, user in users.items()
+            if user.state != STATE_SETUP_COMPLETE and user.last_seen < cutoff
+        ]
+        for chat_id in stale:
+            cancel_checks(chat_id)
+            users.pop(chat_id)
+        if stale:
+            logging.info(f"🧹 Removed {len(stale)} abandoned setups")
 
 # ==== TOMTOM API FUNCTION (ENHANCED LOGGING) ====
 
-def send_tomtom_update(chat_id, mode):
-    """Send traffic update using TomTom API."""
+async def init_http_session():
+    """Create the shared aiohttp session once the bot's event loop is running."""
+    global http_session
+    connector = aiohttp.TCPConnector(
+        limit=100, limit_per_host=50, ttl_dns_cache=600, keepalive_timeout=60, enable_cleanup_closed=True
+    )
+    http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10))
+    logging.info("🌐 TomTom HTTP session ready")
+
+async def close_http_session():
+    """Close the shared aiohttp session on shutdown."""
+    if http_session:
+        await http_session.close()
+
+def build_route_urls(user):
+    """Precompute the user's calculateRoute URLs for both directions once locations are known."""
+    home, office = f"{user.home_lat},{user.home_lon}", f"{user.office_lat},{user.office_lon}"
+    user.office_url = f"https://api.tomtom.com/routing/1/calculateRoute/{home}:{office}/json"
+    user.home_url = f"https://api.tomtom.com/routing/1/calculateRoute/{office}:{home}/json"
+
+async def fetch_route_summary(start_lat, start_lon, end_lat, end_lon, url):
+    """Fetch a TomTom route summary, reusing a recent or in-flight result for the same route.
+
+    Lookups that arrive within MATRIX_BATCH_WINDOW_SECS of each other are resolved together
+    by run_route_batch; `url` is the route's precomputed calculateRoute URL. Returns
+    (status, summary); summary is None if the request failed or no route was found.
+    """
+    global route_batch_handle
+    
+    # ~100m coordinate precision, so nearby users with the same commute share one API call
+    cache_key = (round(start_lat, 3), round(start_lon, 3), round(end_lat, 3), round(end_lon, 3))
+    cached = route_cache.get(cache_key)
+    if cached is not None and cached[0] > time.monotonic():
+        logging.info("♻️ Using cached TomTom route data")
+        return 200, cached[1]
+    
+    # Join a request already on its way to TomTom, or one waiting for the next batch
+    future = inflight_routes.get(cache_key)
+    if future is None:
+        pending = pending_routes.get(cache_key)
+        if pending is None:
+            future = asyncio.get_running_loop().create_future()
+            pending = pending_routes[cache_key] = ((start_lat, start_lon), (end_lat, end_lon), url, future)
+            if route_batch_handle is None:
+                route_batch_handle = asyncio.get_running_loop().call_later(MATRIX_BATCH_WINDOW_SECS, start_route_batch)
+        future = pending[3]
+    
+    return await asyncio.shield(future)
+
+def start_route_batch():
+    """Timer callback: hand every pending route lookup to run_route_batch."""
+    global pending_routes, route_batch_handle
+    batch, pending_routes, route_batch_handle = pending_routes, {}, None
+    inflight_routes.update((cache_key, pending[3]) for cache_key, pending in batch.items())
+    spawn(run_route_batch(batch))
+
+async def run_route_batch(batch):
+    """Resolve a batch of route lookups, sharing Matrix Routing requests between routes where that pays off."""
     try:
-        data = user_data.get(chat_id)
-        if not data:
+        await resolve_route_batch(batch)
+    finally:
+        for cache_key, (_, _, _, future) in batch.items():
+            if inflight_routes.get(cache_key) is future:
+                del inflight_routes[cache_key]
+
+async def resolve_route_batch(batch):
+    """Group a batch into TomTom requests and settle every lookup's future with its result."""
+    chunks, current, origins, destinations = [], [], set(), set()
+    # Sorting puts routes with the same destination (then origin) next to each other,
+    # so the routes grouped below can share matrix rows and columns
+    for cache_key, (start, end, url, future) in sorted(batch.items(), key=lambda item: (item[1][1], item[1][0])):
+        # Matrix requests are billed per origins x destinations cell, so only grow a chunk
+        # while it stays under the size cap and the unused cross-product cells stay bounded
+        cells = len(origins | {start}) * len(destinations | {end})
+        if current and (cells > MATRIX_MAX_CELLS or cells > MATRIX_MAX_CELLS_PER_ROUTE * (len(current) + 1)):
+            chunks.append(current)
+            current, origins, destinations = [], set(), set()
+        current.append((cache_key, start, end, url))
+        origins.add(start)
+        destinations.add(end)
+    if current:
+        chunks.append(current)
+    
+    results = await asyncio.gather(*(
+        request_route_matrix(chunk) if len(chunk) > 1 else request_route(chunk[0][0], chunk[0][3])
+        for chunk in chunks
+    ), return_exceptions=True)
+    
+    # Settle each chunk on its own, so one failed request doesn't fail routes that resolved
+    for chunk, chunk_results in zip(chunks, results):
+        if isinstance(chunk_results, BaseException):
+            logging.error(f"💥 TomTom lookup failed for {len(chunk)} routes: {chunk_results!r}")
+            for cache_key, _, _, _ in chunk:
+                batch[cache_key][3].set_exception(chunk_results)
+            continue
+        for cache_key, (status, summary) in chunk_results.items():
+            if summary is not None:
+                cache_route_summary(cache_key, summary)
+            batch[cache_key][3].set_result((status, summary))
+
+def cache_route_summary(cache_key, summary):
+    """Store a route summary for ROUTE_CACHE_TTL_SECS, dropping entries that have expired."""
+    now = time.monotonic()
+    # Every entry lives for the same TTL, so insertion order is expiry order
+    while route_cache:
+        oldest = next(iter(route_cache))
+        if route_cache[oldest][0] > now:
+            break
+        del route_cache[oldest]
+    route_cache.pop(cache_key, None)
+    route_cache[cache_key] = (now + ROUTE_CACHE_TTL_SECS, summary)
+
+async def request_route(cache_key, url):
+    """Look up a single route with the TomTom calculateRoute API."""
+    async with http_session.get(url, params=TOMTOM_ROUTE_PARAMS) as response:
+        logging.debug(f"🌐 TomTom calculateRoute request: HTTP {response.status}")
+        if response.status != 200:
+            logging.error(f"❌ TomTom API error: {response.status} - {await response.text()}")
+            return {cache_key: (response.status, None)}
+        route_data = orjson.loads(await response.read())
+    
+    if not route_data.get("routes"):
+        logging.warning("⚠️ No routes found in TomTom response")
+        return {cache_key: (200, None)}
+    return {cache_key: (200, route_data["routes"][0]["summary"])}
+
+async def request_route_matrix(chunk):
+    """Look up several routes with one TomTom Matrix Routing v2 request."""
+    origins = list(dict.fromkeys(start for _, start, _, _ in chunk))
+    destinations = list(dict.fromkeys(end for _, _, end, _ in chunk))
+    body = {
+        "origins": [{"point": {"latitude": lat, "longitude": lon}} for lat, lon in origins],
+        "destinations": [{"point": {"latitude": lat, "longitude": lon}} for lat, lon in destinations],
+        "options": {"departAt": "now", "traffic": "live", "travelMode": "car", "routeType": "fastest"}
+    }
+    
+    async with http_session.post(
+        "https://api.tomtom.com/routing/matrix/2",
+        params={'key': TOMTOM_API_KEY},
+        data=orjson.dumps(body),
+        headers={'Content-Type': 'application/json'},
+        timeout=aiohttp.ClientTimeout(total=20)
+    ) as response:
+        logging.debug(
+            f"🌐 TomTom Matrix request for {len(chunk)} routes ({len(origins)}x{len(destinations)}): HTTP {response.status}"
+        )
+        if response.status != 200:
+            logging.error(f"❌ TomTom Matrix API error: {response.status} - {await response.text()}")
+            return {cache_key: (response.status, None) for cache_key, _, _, _ in chunk}
+        matrix_data = orjson.loads(await response.read())
+    
+    # Cells without a routeSummary (e.g. unroutable pairs) come back as "no route"
+    cells = {
+        (cell["originIndex"], cell["destinationIndex"]): cell.get("routeSummary")
+        for cell in matrix_data.get("data", [])
+    }
+    return {
+        cache_key: (200, cells.get((origins.index(start), destinations.index(end))))
+        for cache_key, start, end, _ in chunk
+    }
+
+def is_repeat_notice(user, mode, message):
+    """True if this exact notice was the last message sent for the mode, within REPEAT_MESSAGE_WINDOW_SECS.
+
+    Otherwise records it; sending a tier message clears the record.
+    """
+    digest = hashlib.blake2s(message.encode(), digest_size=16).digest()
+    now = time.monotonic()
+    last = getattr(user, f"{mode}_last_notice")
+    if last and last[0] == digest and now - last[1] < REPEAT_MESSAGE_WINDOW_SECS:
+        return True
+    setattr(user, f"{mode}_last_notice", (digest, now))
+    return False
+
+async def send_tomtom_update(chat_id, mode, only_changes=False):
+    """Send traffic update using TomTom API and return the alert tier (None if unavailable).
+
+    With only_changes, the update is skipped when its tier matches the last one sent in
+    this window, so scheduled checks send one baseline plus any transitions; failure
+    notices are likewise skipped while identical to a recent one.
+    """
+    try:
+        user = users.get(chat_id)
+        if not user:
             logging.error(f"❌ No user data found for TomTom update - chat_id: {chat_id}")
             return
         
         if mode == "office":
             # From home to office
-            start_lat, start_lon = data["home_lat"], data["home_lon"]
-            end_lat, end_lon = data["office_lat"], data["office_lon"]
+            start_lat, start_lon = user.home_lat, user.home_lon
+            end_lat, end_lon = user.office_lat, user.office_lon
             route_desc = "🏠➡️🏢 Home to Office"
+            url = user.office_url
         else:
             # From office to home
-            start_lat, start_lon = data["office_lat"], data["office_lon"]
-            end_lat, end_lon = data["home_lat"], data["home_lon"]
+            start_lat, start_lon = user.office_lat, user.office_lon
+            end_lat, end_lon = user.home_lat, user.home_lon
             route_desc = "🏢➡️🏠 Office to Home"
+            url = user.home_url
         
         logging.info(f"🚗 Fetching traffic data for {route_desc} (User: {chat_id})")
         logging.info(f"📍 Route: ({start_lat:.4f},{start_lon:.4f}) → ({end_lat:.4f},{end_lon:.4f})")
         
-        url = f"https://api.tomtom.com/routing/1/calculateRoute/{start_lat},{start_lon}:{end_lat},{end_lon}/json"
-        params = {
-            'key': TOMTOM_API_KEY,
-            'traffic': 'true',
-            'departAt': now_ist().isoformat()
-        }
+        status, summary = await fetch_route_summary(start_lat, start_lon, end_lat, end_lon, url)
         
-        logging.info(f"🌐 Making TomTom API request...")
-        response = requests.get(url, params=params, timeout=10)
-        logging.info(f"📡 TomTom API response: {response.status_code}")
-        
-        if response.status_code == 200:
-            route_data = response.json()
-            logging.info("✅ TomTom API response received successfully")
+        tier = None
+        if summary:
+            travel_time_mins = summary["travelTimeInSeconds"] // 60
+            delay_seconds = summary.get("trafficDelayInSeconds", 0)
+            delay_mins = delay_seconds // 60
             
-            if route_data.get("routes"):
-                summary = route_data["routes"][0]["summary"]
-                travel_time_mins = summary["travelTimeInSeconds"] // 60
-                delay_seconds = summary.get("trafficDelayInSeconds", 0)
-                delay_mins = delay_seconds // 60
-                
-                current_time = now_ist().strftime("%H:%M")
-                logging.info(f"📊 Traffic data: {travel_time_mins}min travel, {delay_mins}min delay")
-                
-                # Smart delay alerting with thresholds
-                if delay_mins >= TRAFFIC_DELAY_THRESHOLD_MINS:
-                    # Significant delay - urgent alert
-                    message = (
-                        f"🚨 {route_desc} Traffic Alert!\n"
-                        f"⏰ Time: {current_time}\n"
-                        f"🕐 Total travel time: {travel_time_mins} mins\n"
-                        f"🚦 Traffic delay: {delay_mins} mins\n"
-                        f"💡 Consider leaving early!"
-                    )
-                elif delay_mins >= MINOR_DELAY_THRESHOLD_MINS:
-                    # Minor delay - informational
-                    message = (
-                        f"⚠️ {route_desc} Traffic Update\n"
-                        f"⏰ Time: {current_time}\n"
-                        f"🕐 Total travel time: {travel_time_mins} mins\n"
-                        f"🚦 Minor delay: {delay_mins} mins\n"
-                        f"ℹ️ Normal traffic conditions"
-                    )
-                else:
-                    # No significant delay
-                    message = (
-                        f"✅ {route_desc} Traffic Update\n"
-                        f"⏰ Time: {current_time}\n"
-                        f"🕐 Travel time: {travel_time_mins} mins\n"
-                        f"🚦 No delays - all clear!"
-                    )
-            else:
-                message = f"❌ No route found for {route_desc}"
-                logging.warning("⚠️ No routes found in TomTom response")
+            current_time = now_ist().strftime("%H:%M")
+            logging.info(f"📊 Traffic data: {travel_time_mins}min travel, {delay_mins}min delay")
+            
+            # Smart delay alerting with thresholds: 0 = clear, 1 = minor, 2 = urgent
+            tier = (delay_mins >= MINOR_DELAY_THRESHOLD_MINS) + (delay_mins >= TRAFFIC_DELAY_THRESHOLD_MINS)
+            if only_changes:
+                if tier == getattr(user, f"{mode}_tier"):
+                    logging.info(f"🔕 Tier unchanged ({tier}) for {route_desc} (User: {chat_id}), not sending")
+                    return tier
+                setattr(user, f"{mode}_tier", tier)
+                setattr(user, f"{mode}_last_notice", None)  # Only back-to-back notices count as repeats
+            message = ALERT_TEMPLATES[tier].format(
+                route=route_desc, time=current_time, travel=travel_time_mins, delay=delay_mins
+            )
+        elif status == 200:
+            message = f"❌ No route found for {route_desc}"
         else:
-            message = f"❌ Failed to fetch traffic data for {route_desc} (Status: {response.status_code})"
-            logging.error(f"❌ TomTom API error: {response.status_code} - {response.text}")
+            message = f"❌ Failed to fetch traffic data for {route_desc} (Status: {status})"
         
-        # Add message to queue for thread-safe sending
-        message_queue.put((chat_id, message))
-        logging.info(f"📨 Message queued for user {chat_id}")
+        if only_changes and tier is None and is_repeat_notice(user, mode, message):
+            logging.debug(f"🔕 Repeated notice for {route_desc} (User: {chat_id}), not sending")
+            return tier
+        if tier is None:
+            # The user's latest message is now a failure, so the next good result is a fresh baseline
+            setattr(user, f"{mode}_tier", None)
+        queue_message(chat_id, message)
+        return tier
         
     except Exception as e:
-        logging.error(f"💥 Error in send_tomtom_update: {e}")
-        message_queue.put((chat_id, f"❌ Error getting traffic update: {str(e)}"))
+        # aiohttp timeouts stringify to "", so name the common TomTom failures explicitly
+        if isinstance(e, asyncio.TimeoutError):
+            reason = "TomTom request timed out"
+        elif isinstance(e, aiohttp.ClientError):
+            reason = f"could not reach TomTom ({type(e).__name__})"
+        else:
+            reason = str(e) or type(e).__name__
+        logging.error(f"💥 Error in send_tomtom_update: {reason} ({e!r})")
+        message = f"❌ Error getting traffic update: {reason}"
+        user = users.get(chat_id)
+        if not (only_changes and user and is_repeat_notice(user, mode, message)):
+            if user:
+                setattr(user, f"{mode}_tier", None)
+            queue_message(chat_id, message)
 
-# ==== MESSAGE QUEUE PROCESSOR (ENHANCED) ====
+# ==== MESSAGE SENDING ====
 
-async def message_queue_processor():
-    """Process messages from the queue and send them."""
-    logging.info("📬 Message queue processor started!")
-    
-    while True:
+def queue_message(chat_id, message):
+    """Buffer an update so a chat's updates within BATCH_FLUSH_INTERVAL share one send."""
+    global outbox_handle
+    outbox.setdefault(chat_id, []).append(message)
+    if outbox_handle is None:
+        outbox_handle = asyncio.get_running_loop().call_later(BATCH_FLUSH_INTERVAL, flush_outbox)
+
+def flush_outbox():
+    """Timer callback: send every chat's buffered updates."""
+    global outbox, outbox_handle
+    batches, outbox, outbox_handle = outbox, {}, None
+    for chat_id, messages in batches.items():
+        spawn(send_batch(chat_id, messages))
+
+async def send_batch(chat_id, messages):
+    """Send buffered updates joined by BATCH_SEPARATOR, in as few messages as MAX_BATCH_CHARS allows."""
+    text = messages[0]
+    for message in messages[1:]:
+        if len(text) + len(BATCH_SEPARATOR) + len(message) > MAX_BATCH_CHARS:
+            await send_message(chat_id, text)
+            text = message
+        else:
+            text += BATCH_SEPARATOR + message
+    await send_message(chat_id, text)
+
+async def send_message(chat_id, message):
+    """Send a message straight from the event loop, logging (not raising) on failure.
+
+    Rate limiting and flood-control retries happen in the bot's AIORateLimiter; network
+    errors are retried here with jittered exponential backoff, up to SEND_MAX_ATTEMPTS tries.
+    """
+    logging.info(f"📤 Sending message to user {chat_id}")
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
         try:
-            if not message_queue.empty():
-                chat_id, message = message_queue.get_nowait()
-                logging.info(f"📤 Sending message to user {chat_id}")
-                await app.bot.send_message(chat_id=chat_id, text=message)
-                message_queue.task_done()
-                logging.info(f"✅ Message sent successfully to user {chat_id}")
-            else:
-                await asyncio.sleep(1)  # Wait 1 second before checking again
+            await app.bot.send_message(chat_id=chat_id, text=message)
+            logging.info(f"✅ Message sent successfully to user {chat_id}")
+            return
+        except BadRequest as e:  # A NetworkError subclass, but retrying won't help
+            logging.error(f"💥 Error sending message to user {chat_id}: {e}")
+            return
+        except NetworkError as e:
+            delay = random.uniform(0, min(SEND_BACKOFF_MAX_SECS, SEND_BACKOFF_BASE_SECS * 2 ** attempt))
+            logging.warning(f"🔁 Network error sending to user {chat_id}: {e}, retrying in {delay:.1f}s")
         except Exception as e:
-            logging.error(f"💥 Error processing message queue: {e}")
-            await asyncio.sleep(5)  # Wait 5 seconds on error
+            logging.error(f"💥 Error sending message to user {chat_id}: {e}")
+            return
+        if attempt < SEND_MAX_ATTEMPTS:
+            await asyncio.sleep(delay)
+    logging.error(f"💥 Giving up on message to user {chat_id} after {SEND_MAX_ATTEMPTS} attempts")
 
 async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Debug command to check scheduler status."""
     chat_id = update.message.chat_id
-    now = now_ist().replace(tzinfo=None)
+    now = time.time()
     
-    message = f"🔍 Debug Info (IST Time: {now.strftime('%H:%M:%S')})\n\n"
+    message = f"🔍 Debug Info (IST Time: {format_ist(now, '%H:%M:%S')})\n\n"
     
     # Check user data
-    data = user_data.get(chat_id)
-    if data:
+    user = users.get(chat_id)
+    if user:
         message += f"✅ User data exists\n"
-        message += f"🏠➡️🏢 Office time: {data.get('office_start_time', 'N/A')}\n"
-        message += f"🏢➡️🏠 Home time: {data.get('home_start_time', 'N/A')}\n"
+        message += f"🏠➡️🏢 Office time: {user.office_start_time or 'N/A'}\n"
+        message += f"🏢➡️🏠 Home time: {user.home_start_time or 'N/A'}\n"
     else:
         message += f"❌ No user data found\n"
     
     # Check scheduler
-    checks = user_next_checks.get(chat_id)
-    if checks:
+    if user and user.is_scheduled:
         message += f"\n✅ Scheduler active\n"
-        office_next = checks.get("office")
-        home_next = checks.get("home")
-        office_end = checks.get("office_end")
-        home_end = checks.get("home_end")
+        office_next, office_end = user.office_next, user.office_end
+        home_next, home_end = user.home_next, user.home_end
         
-        message += f"🏠➡️🏢 Office window: {office_next.strftime('%H:%M') if office_next else 'N/A'} to {office_end.strftime('%H:%M') if office_end else 'N/A'}\n"
-        message += f"🏢➡️🏠 Home window: {home_next.strftime('%H:%M') if home_next else 'N/A'} to {home_end.strftime('%H:%M') if home_end else 'N/A'}\n"
+        message += f"🏠➡️🏢 Office window: {format_ist(office_next) if office_next else 'N/A'} to {format_ist(office_end) if office_end else 'N/A'}\n"
+        message += f"🏢➡️🏠 Home window: {format_ist(home_next) if home_next else 'N/A'} to {format_ist(home_end) if home_end else 'N/A'}\n"
         
         # Check if in active window
         if office_next and office_end and office_next <= now <= office_end:
@@ -441,7 +1014,7 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         message += f"\n❌ Scheduler not active\n"
     
-    message += f"\n📊 Total active users: {len(user_next_checks)}"
+    message += f"\n📊 Total active users: {sum(1 for u in users.values() if u.is_scheduled)}"
     
     await update.message.reply_text(message)
 
@@ -449,64 +1022,38 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    data = user_data.get(chat_id)
-    state = user_state.get(chat_id)
-    
-    if not data or state != STATE_SETUP_COMPLETE:
-        await update.message.reply_text(
-            "❌ Setup not complete. Please use /start to configure your commute."
-        )
+    user = require_setup(chat_id)
+    if user is None:
+        await update.message.reply_text(SETUP_INCOMPLETE_MESSAGE)
         return
     
+    # Start the TomTom lookup first so it runs while the acknowledgement is being sent
+    update_task = asyncio.create_task(send_tomtom_update(chat_id, "office"))
     await update.message.reply_text("🧪 Testing traffic update... Please wait.")
-    
-    # Send immediate test update
-    await send_tomtom_update_async(chat_id, "office")
+    await update_task
     logging.info(f"🧪 Test traffic update triggered for user {chat_id}")
 
 # ==== OTHER COMMANDS ====
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    data = user_data.get(chat_id)
-    state = user_state.get(chat_id)
-    
-    if not data or state != STATE_SETUP_COMPLETE:
-        await update.message.reply_text(
-            "❌ Setup not complete. Please use /start to configure your commute."
-        )
+    if require_setup(update.message.chat_id) is None:
+        await update.message.reply_text(SETUP_INCOMPLETE_MESSAGE)
         return
     
-    message = (
-        f"⚙️ Traffic Alert Settings\n\n"
-        f"🚨 Urgent Alert Threshold: {TRAFFIC_DELAY_THRESHOLD_MINS} minutes\n"
-        f"⚠️ Minor Alert Threshold: {MINOR_DELAY_THRESHOLD_MINS} minutes\n\n"
-        f"📊 Current thresholds:\n"
-        f"• ≥{TRAFFIC_DELAY_THRESHOLD_MINS} mins: 🚨 Urgent alert with 'leave early' advice\n"
-        f"• {MINOR_DELAY_THRESHOLD_MINS}-{TRAFFIC_DELAY_THRESHOLD_MINS-1} mins: ⚠️ Minor delay notification\n"
-        f"• <{MINOR_DELAY_THRESHOLD_MINS} mins: ✅ All clear message\n\n"
-        f"💡 Contact admin to adjust thresholds if needed."
-    )
-    
-    await update.message.reply_text(message)
+    await update.message.reply_text(SETTINGS_MESSAGE)
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    data = user_data.get(chat_id)
-    state = user_state.get(chat_id)
-    
-    if not data or state != STATE_SETUP_COMPLETE:
-        await update.message.reply_text(
-            "❌ Setup not complete. Please use /start to configure your commute."
-        )
+    user = require_setup(chat_id)
+    if user is None:
+        await update.message.reply_text(SETUP_INCOMPLETE_MESSAGE)
         return
     
-    office_time = data["office_start_time"].strftime("%H:%M")
-    home_time = data["home_start_time"].strftime("%H:%M")
+    office_time = user.office_start_time.strftime("%H:%M")
+    home_time = user.home_start_time.strftime("%H:%M")
     
     # Check if user is in scheduler
-    is_scheduled = chat_id in user_next_checks
-    next_checks = user_next_checks.get(chat_id, {})
+    is_scheduled = user.is_scheduled
     
     message = (
         f"📊 Traffic Bot Status\n\n"
@@ -518,27 +1065,27 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     if is_scheduled:
-        now = now_ist().replace(tzinfo=None)
-        office_next = next_checks.get("office")
-        home_next = next_checks.get("home")
+        now = time.time()
+        office_next = user.office_next
+        home_next = user.home_next
         
         message += "⏰ Next Updates:\n"
         if office_next:
             if office_next > now:
-                message += f"🏠➡️🏢 Office: {office_next.strftime('%H:%M')}\n"
+                message += f"🏠➡️🏢 Office: {format_ist(office_next)}\n"
             else:
                 message += f"🏠➡️🏢 Office: Active now\n"
         
         if home_next:
             if home_next > now:
-                message += f"🏢➡️🏠 Home: {home_next.strftime('%H:%M')}\n"
+                message += f"🏢➡️🏠 Home: {format_ist(home_next)}\n"
             else:
                 message += f"🏢➡️🏠 Home: Active now\n"
     else:
         message += "⚠️ Scheduler not active. Try /start to reinitialize."
     
     message += (
-        f"\n\nℹ️ Update frequency: Every 2 minutes during active periods\n"
+        f"\n\nℹ️ Update frequency: Every 2 minutes during active periods (10 while clear), sent when the alert level changes\n"
         f"🧪 Test now: /test\n"
         f"🔍 Debug info: /debug"
     )
@@ -547,7 +1094,25 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==== MAIN FUNCTION (ENHANCED) ====
 
-def main():
+async def on_startup(application):
+    """Open the HTTP session and resume tracking for restored users before polling starts."""
+    await init_http_session()
+    restored = [chat_id for chat_id, user in users.items() if user.state == STATE_SETUP_COMPLETE]
+    for chat_id in restored:
+        if users[chat_id].office_url is None:
+            build_route_urls(users[chat_id])  # Saved before URLs were precomputed
+        await schedule_tracking(chat_id)
+    logging.info(f"♻️ Resumed tracking for {len(restored)} restored users")
+
+async def on_shutdown(application):
+    """Send buffered updates, save pending user changes and close the HTTP session once polling has stopped."""
+    if outbox_handle:
+        outbox_handle.cancel()
+        await asyncio.gather(*(send_batch(chat_id, messages) for chat_id, messages in outbox.items()))
+    flush_user_db()
+    await close_http_session()
+
+async def main():
     global app
     
     # Check environment variables
@@ -559,9 +1124,24 @@ def main():
         logging.error("❌ TOMTOM_API_KEY not found in environment variables!")
         return
     
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logging.error("❌ WEBHOOK_SECRET must be set when WEBHOOK_URL is (otherwise anyone can post updates)!")
+        return
+    
     logging.info("✅ Environment variables loaded successfully")
     
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    open_user_db(USER_DB_PATH)
+    
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(AIORateLimiter(overall_max_rate=TELEGRAM_GLOBAL_RATE, max_retries=TELEGRAM_RATE_LIMIT_RETRIES))
+        .build()
+    )
+    
+    # Runs before the handlers below, for every update
+    app.add_handler(TypeHandler(Update, track_last_seen), group=-1)
     
     # Command handlers
     app.add_handler(CommandHandler("start", start))
@@ -577,20 +1157,48 @@ def main():
     logging.info("🤖 Traffic Alert Bot is starting...")
     print("🤖 Traffic Alert Bot is running...")
     
-    # Create and set new event loop for Railway compatibility
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-    # Start background tasks
-    loop.create_task(message_queue_processor())
-    loop.create_task(async_scheduler())
-    
-    logging.info("🚀 Background tasks started!")
+    # Stop cleanly on Ctrl+C or Railway's SIGTERM
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows event loops; use a plain signal handler instead
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
     
-    app.run_polling()
+    # Bot, scheduler and background tasks all share the loop started by asyncio.run
+    async with app:
+        await on_startup(app)
+        try:
+            await app.start()
+            if WEBHOOK_URL:
+                await app.updater.start_webhook(
+                    listen="0.0.0.0",
+                    port=PORT,
+                    url_path="telegram",
+                    webhook_url=f"{WEBHOOK_URL.rstrip('/')}/telegram",
+                    secret_token=WEBHOOK_SECRET
+                )
+                logging.info(f"🔗 Receiving updates via webhook on port {PORT}")
+            else:
+                await app.updater.start_polling()
+            async with asyncio.TaskGroup() as tg:
+                background = [tg.create_task(scheduler_heartbeat()), tg.create_task(prune_stale_users())]
+                logging.info("🚀 Background tasks started!")
+                await stop_event.wait()
+                for task in background:
+                    task.cancel()
+        finally:
+            logging.info("🛑 Traffic Alert Bot is stopping...")
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+            await on_shutdown(app)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(main())
+    except KeyboardInterrupt:
+        pass  # Shutdown already ran in main()'s finally block
\ No newline at end of file